@@ -1,112 +1,209 @@
 import json
+import numbers
 import os
+import re
+import time
+from functools import lru_cache
 import httpx
+import numpy as np
+import orjson
 import pandas as pd
 from pathlib import Path
-from playwright.sync_api import sync_playwright
-from bs4 import BeautifulSoup
-from thefuzz import fuzz, process
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError, sync_playwright
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+from selectolax.lexbor import LexborHTMLParser
 
 # Constants
 OPENROUTER_MODELS_URL = "https://openrouter.ai/api/v1/models"
 ARTIFICIAL_ANALYSIS_URL = "https://artificialanalysis.ai/leaderboards/models"
 CACHE_DIR = Path("data/cache")
+PLAYWRIGHT_PROFILE_DIR = CACHE_DIR / "pw-profile"
+OPENROUTER_CACHE_TTL = 60 * 60  # seconds before the OpenRouter cache is revalidated
 ALIASES_FILE = Path("data/model_aliases.json")
 REPORT_FILE = Path("output/free_models_report.md")
 HTML_REPORT_FILE = Path("output/free_models_report.html")
 
-def fetch_openrouter_free_models(force_fetch=False):
-    """Fetch models from OpenRouter and filter for free ones."""
+# Minimum fuzzy score (0-100) for a match; kept high so uncertain models stay unmatched
+FUZZY_MATCH_THRESHOLD = 90
+
+# Benchmark columns a scraped leaderboard must contain to count as complete
+EXPANDED_AA_COLUMNS = {
+    "GPQA Diamond(ScientificReasoning)",
+    "LiveCodeBench(Coding)",
+}
+
+# Name normalization patterns
+_PUNCT_RE = re.compile(r"[^a-z0-9\s.]")
+_SUFFIX_RE = re.compile(
+    r"\b(?:instruct|chat|it|v[1-4]|free|experimental|exp|preview|thinking|think|coder|vl)\b"
+)
+
+def load_openrouter_models(force_fetch=False):
+    """Load the OpenRouter model list, revalidating the cache with its ETag when stale."""
     cache_file = CACHE_DIR / "openrouter_models.json"
+    etag_file = CACHE_DIR / "openrouter_models.etag"
     
-    if cache_file.exists() and not force_fetch:
+    cache_fresh = cache_file.exists() and time.time() - cache_file.stat().st_mtime < OPENROUTER_CACHE_TTL
+    if cache_fresh and not force_fetch:
         print("Loading OpenRouter models from cache...")
-        with open(cache_file, "r") as f:
-            data = json.load(f)
+        return orjson.loads(cache_file.read_bytes())
+    
+    headers = {}
+    if cache_file.exists() and etag_file.exists():
+        headers["If-None-Match"] = etag_file.read_text().strip()
+    
+    print("Fetching OpenRouter models from API...")
+    try:
+        response = httpx.get(OPENROUTER_MODELS_URL, headers=headers)
+        if response.status_code != 304:
+            response.raise_for_status()
+    except httpx.HTTPError as e:
+        if force_fetch or not cache_file.exists():
+            raise
+        print(f"Could not refresh OpenRouter models ({e}), loading from cache...")
+        return orjson.loads(cache_file.read_bytes())
+    
+    if response.status_code == 304:
+        print("OpenRouter models unchanged, loading from cache...")
+        # Restart the TTL window without rewriting the cache
+        cache_file.touch()
+        return orjson.loads(cache_file.read_bytes())
+    
+    data = orjson.loads(response.content)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_file.write_bytes(orjson.dumps(data))
+    etag = response.headers.get("ETag")
+    if etag:
+        etag_file.write_text(etag)
     else:
-        print("Fetching OpenRouter models from API...")
-        response = httpx.get(OPENROUTER_MODELS_URL)
-        response.raise_for_status()
-        data = response.json()
-        CACHE_DIR.mkdir(parents=True, exist_ok=True)
-        with open(cache_file, "w") as f:
-            json.dump(data, f, indent=2)
-    
-    free_models = []
-    for model in data.get("data", []):
-        pricing = model.get("pricing", {})
-        # Check if all pricing fields are "0"
-        is_free = all(str(v) == "0" for v in pricing.values())
-        if is_free:
-            free_models.append({
-                "id": model.get("id"),
-                "name": model.get("name"),
-                "context_length": model.get("context_length"),
-                "description": model.get("description")
-            })
+        etag_file.unlink(missing_ok=True)
+    
+    return data
+
+def fetch_openrouter_free_models(force_fetch=False):
+    """Fetch models from OpenRouter and filter for free ones."""
+    data = load_openrouter_models(force_fetch=force_fetch)
+    
+    # Flatten pricing into columns and check them all at once
+    models_df = pd.json_normalize(data.get("data", []), sep=".")
+    pricing = models_df.filter(regex=r"^pricing\.")
+    prices = pricing.apply(pd.to_numeric, errors="coerce")
+    # Free if every listed pricing field is zero (fields a model omits don't count)
+    free_mask = (prices.eq(0) | pricing.isna()).all(axis=1)
+    
+    free_df = models_df.loc[free_mask].reindex(columns=["id", "name", "context_length", "description"])
+    free_models = free_df.astype(object).where(free_df.notna(), None).to_dict(orient="records")
     
     print(f"Found {len(free_models)} free models on OpenRouter.")
     return free_models
 
-def scrape_artificial_analysis(force_fetch=False):
-    """Scrape Artificial Analysis leaderboard using Playwright."""
-    cache_file = CACHE_DIR / "artificial_analysis_leaderboard.json"
+def parse_leaderboard_table(content):
+    """Parse the Artificial Analysis leaderboard table into a list of row dicts."""
+    table = LexborHTMLParser(content).css_first("table")
+    if table is None:
+        raise ValueError("Could not find table on Artificial Analysis.")
     
-    if cache_file.exists() and not force_fetch:
-        print("Loading Artificial Analysis data from cache...")
-        with open(cache_file, "r") as f:
-            return json.load(f)
+    header_rows = table.css("thead tr")
+    if len(header_rows) < 2:
+        raise ValueError("Unexpected table header structure.")
     
-    print("Scraping Artificial Analysis leaderboard...")
-    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    # Use the second header row for column names
+    headers = [th.text(strip=True) for th in header_rows[1].css("th, td")]
+    
+    data = []
+    for tr in table.css("tbody tr"):
+        cells = tr.css("td")
+        if len(cells) != len(headers):
+            continue
+        
+        data.append({header: cell.text(strip=True) for header, cell in zip(headers, cells)})
+    
+    return data
+
+def fetch_leaderboard_static():
+    """Fetch the leaderboard over plain HTTP, returning None if a browser is needed."""
+    try:
+        response = httpx.get(ARTIFICIAL_ANALYSIS_URL, follow_redirects=True, timeout=30)
+        response.raise_for_status()
+        data = parse_leaderboard_table(response.text)
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"Static leaderboard fetch failed ({e}), falling back to Playwright...")
+        return None
+    
+    if not data or not EXPANDED_AA_COLUMNS.issubset(data[0]):
+        print("Static leaderboard is missing expanded columns, falling back to Playwright...")
+        return None
+    
+    return data
+
+def render_leaderboard_page():
+    """Render the leaderboard with Playwright, with all metric columns expanded."""
     with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
+        # Reuse a persistent profile so Chromium keeps its caches between runs
+        context = p.chromium.launch_persistent_context(
+            user_data_dir=str(PLAYWRIGHT_PROFILE_DIR),
+            headless=True,
+            accept_downloads=False,
+        )
+        page = context.pages[0] if context.pages else context.new_page()
         page.goto(ARTIFICIAL_ANALYSIS_URL)
         page.wait_for_selector("table")
         
         # Expand columns to get all metrics
         expand_button = page.get_by_role("button", name="Expand Columns")
         if expand_button.is_visible():
+            header_selector = "table thead tr:nth-child(2) > *"
+            column_count = page.locator(header_selector).count()
             expand_button.click()
-            page.wait_for_timeout(2000)
+            # Wait for the extra columns to render instead of sleeping
+            try:
+                page.wait_for_function(
+                    "([selector, count]) => document.querySelectorAll(selector).length > count",
+                    arg=[header_selector, column_count],
+                    timeout=10000,
+                )
+            except PlaywrightTimeoutError:
+                # Columns may render elsewhere or already be expanded; use what is there
+                print("Warning: header columns did not grow after expanding, continuing...")
         
         content = page.content()
-        browser.close()
-    
-    soup = BeautifulSoup(content, "html.parser")
-    table = soup.find("table")
-    if not table:
-        print("Error: Could not find table on Artificial Analysis.")
-        return []
-    
-    thead = table.find("thead")
-    header_rows = thead.find_all("tr")
-    if len(header_rows) < 2:
-        print("Error: Unexpected table header structure.")
-        return []
+        context.close()
     
-    # Use the second header row for column names
-    headers = [th.get_text(strip=True) for th in header_rows[1].find_all(["th", "td"])]
+    return content
+
+def scrape_artificial_analysis(force_fetch=False):
+    """Scrape Artificial Analysis leaderboard, using Playwright only when needed."""
+    cache_file = CACHE_DIR / "artificial_analysis_leaderboard.json"
     
-    data = []
-    tbody = table.find("tbody")
-    for tr in tbody.find_all("tr"):
-        cells = tr.find_all("td")
-        if len(cells) != len(headers):
-            continue
-        
-        row_dict = {}
-        for header, cell in zip(headers, cells):
-            row_dict[header] = cell.get_text(strip=True)
-        data.append(row_dict)
+    if cache_file.exists() and not force_fetch:
+        print("Loading Artificial Analysis data from cache...")
+        return orjson.loads(cache_file.read_bytes())
     
-    with open(cache_file, "w") as f:
-        json.dump(data, f, indent=2)
+    print("Scraping Artificial Analysis leaderboard...")
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    data = fetch_leaderboard_static()
+    if data is None:
+        try:
+            data = parse_leaderboard_table(render_leaderboard_page())
+        except ValueError as e:
+            print(f"Error: {e}")
+            return []
+    
+    # Leave the cache untouched when the leaderboard has not changed
+    new_bytes = orjson.dumps(data)
+    cache_unchanged = (
+        cache_file.exists()
+        and cache_file.stat().st_size == len(new_bytes)
+        and cache_file.read_bytes() == new_bytes
+    )
+    if not cache_unchanged:
+        cache_file.write_bytes(new_bytes)
     
     print(f"Scraped {len(data)} models from Artificial Analysis.")
     return data
 
+@lru_cache(maxsize=4096)
 def normalize_name(name):
     """Normalize model name for better matching."""
     if not name:
@@ -119,26 +216,25 @@ def normalize_name(name):
     if ":" in name:
         name = name.split(":", 1)[1].strip()
     
-    # Remove common suffixes
-    suffixes = [
-        "instruct", "chat", "it", "v1", "v2", "v3", "v4", 
-        "(free)", "free", "experimental", "exp", "preview",
-        "thinking", "think", "coder", "vl"
-    ]
-    
-    # Remove punctuation and extra whitespace
-    import re
-    name = re.sub(r"[^a-z0-9\s\.]", " ", name)
-    
-    # Remove suffixes as whole words
-    for suffix in suffixes:
-        name = re.sub(rf"\b{suffix}\b", "", name)
+    # Remove punctuation, then common suffixes (e.g. "instruct", "free") as whole words
+    name = _PUNCT_RE.sub(" ", name)
+    name = _SUFFIX_RE.sub("", name)
     
     # Collapse whitespace
     name = " ".join(name.split())
     
     return name
 
+def _fuzzy_key(name):
+    """Lowercase and strip punctuation from a raw name, then sort its tokens.
+    
+    Fuzzy scoring deliberately uses the raw name rather than normalize_name:
+    keeping the provider prefix and suffixes stops names that differ only in
+    a version digit (e.g. "Solar Pro 3" vs "Solar Pro 2") from scoring above
+    the threshold.
+    """
+    return " ".join(sorted(default_process(name or "").split()))
+
 def match_models(free_models, aa_data):
     """Match OpenRouter models with Artificial Analysis data."""
     # Load aliases
@@ -148,63 +244,108 @@ def match_models(free_models, aa_data):
             aliases = json.load(f)
     
     # Prepare AA data for matching
-    aa_df = pd.DataFrame(aa_data)
-    aa_names = aa_df["Model"].tolist()
-    aa_norm_map = {normalize_name(name): name for name in aa_names}
-    
-    matched_results = []
+    aa_names = [row["Model"] for row in aa_data]
+    # Normalize each AA name once for exact lookups
+    aa_norm_names = [normalize_name(name) for name in aa_names]
+    aa_norm_map = dict(zip(aa_norm_names, aa_names))
+    # Index rows once by model name without redundant columns, keeping the
+    # first row for duplicated names
+    redundant_cols = ("Model", "Creator", "ContextWindow")
+    aa_rows = {
+        row["Model"]: {k: v for k, v in row.items() if k not in redundant_cols}
+        for row in reversed(aa_data)
+    }
     
-    for or_model in free_models:
-        or_id = or_model["id"]
-        or_name = or_model["name"]
-        
-        match_found = False
-        aa_row = None
-        match_type = "unmatched"
-        
+    # Resolve aliases and exact matches first; only the rest needs fuzzy scoring
+    matches = {}
+    residual = []
+    for i, or_model in enumerate(free_models):
         # 1. Check aliases
-        if or_id in aliases:
-            alias_name = aliases[or_id]
-            aa_row = aa_df[aa_df["Model"] == alias_name]
-            if not aa_row.empty:
-                match_found = True
-                match_type = "alias"
+        alias_name = aliases.get(or_model["id"])
+        if alias_name in aa_rows:
+            matches[i] = (alias_name, "alias")
+            continue
         
         # 2. Exact match (normalized)
-        if not match_found:
-            norm_or_name = normalize_name(or_name)
-            if norm_or_name in aa_norm_map:
-                aa_name = aa_norm_map[norm_or_name]
-                aa_row = aa_df[aa_df["Model"] == aa_name]
-                match_found = True
-                match_type = "exact (norm)"
-        
-        # 3. Fuzzy match
-        if not match_found:
-            # Use a high threshold as per plan
-            best_match, score = process.extractOne(or_name, aa_names, scorer=fuzz.token_sort_ratio)
-            if score >= 90:
-                aa_row = aa_df[aa_df["Model"] == best_match]
-                match_found = True
-                match_type = f"fuzzy ({score})"
+        norm_or_name = normalize_name(or_model["name"])
+        if norm_or_name in aa_norm_map:
+            matches[i] = (aa_norm_map[norm_or_name], "exact (norm)")
+            continue
         
+        residual.append(i)
+    
+    # 3. Fuzzy match, scoring all residual models in one batched call.
+    # Sorting tokens up front makes plain ratio equivalent to token_sort_ratio,
+    # and the cutoff lets rapidfuzz stop early on pairs below the threshold.
+    # Scores are rounded into the uint8 matrix, so the cutoff sits half a point
+    # below the threshold to accept everything that rounds up to it.
+    if residual and aa_names:
+        fuzzy_scores = process.cdist(
+            [_fuzzy_key(free_models[i]["name"]) for i in residual],
+            [_fuzzy_key(name) for name in aa_names],
+            scorer=fuzz.ratio,
+            score_cutoff=FUZZY_MATCH_THRESHOLD - 0.5,
+            dtype=np.uint8,
+            workers=-1,
+        )
+        for i, row_scores in zip(residual, fuzzy_scores):
+            # Pairs below the cutoff are stored as 0, so any non-zero best is a match
+            best_idx = int(row_scores.argmax())
+            score = int(row_scores[best_idx])
+            if score >= FUZZY_MATCH_THRESHOLD:
+                matches[i] = (aa_names[best_idx], f"fuzzy ({score})")
+    
+    matched_results = []
+    for i, or_model in enumerate(free_models):
         result = or_model.copy()
-        if match_found and aa_row is not None:
+        if i in matches:
+            aa_name, match_type = matches[i]
             # Merge AA data
-            aa_dict = aa_row.iloc[0].to_dict()
-            # Remove redundant columns
-            aa_dict.pop("Model", None)
-            aa_dict.pop("Creator", None)
-            aa_dict.pop("ContextWindow", None)
-            result.update(aa_dict)
+            result.update(aa_rows[aa_name])
             result["match_status"] = match_type
         else:
             result["match_status"] = "unmatched"
-            
+        
         matched_results.append(result)
     
     return matched_results
 
+def _format_markdown_cell(value):
+    """Format a single value for a Markdown table cell."""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:g}"
+    return str(value).replace("|", "\\|")
+
+def _is_number(value):
+    """Return True for numbers and numeric-looking strings such as "0.47"."""
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return True
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def dataframe_to_markdown(df):
+    """Render a DataFrame as a Markdown pipe table."""
+    cols = df.columns.tolist()
+    # Right-align columns whose values all look numeric, left-align the rest
+    align = [
+        "---:" if all(_is_number(v) for v in df[c] if v is not None) else ":---"
+        for c in cols
+    ]
+    lines = [
+        "| " + " | ".join(_format_markdown_cell(c) for c in cols) + " |",
+        "|" + "|".join(align) + "|",
+    ]
+    lines.extend(
+        "| " + " | ".join(map(_format_markdown_cell, row)) + " |"
+        for row in df.itertuples(index=False, name=None)
+    )
+    return "\n".join(lines)
+
 def generate_report(matched_results):
     """Generate Markdown and HTML reports from matched results."""
     df = pd.DataFrame(matched_results)
@@ -266,7 +407,7 @@ def generate_report(matched_results):
         report_df.sort_values(by="Intelligence", ascending=False, inplace=True)
     
     # 1. Generate Markdown Report
-    markdown_table = report_df.to_markdown(index=False)
+    markdown_table = dataframe_to_markdown(report_df)
     with open(REPORT_FILE, "w", encoding="utf-8") as f:
         f.write("# Free Models Performance Report\n\n")
         f.write(f"Generated on: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n")
@@ -275,9 +416,7 @@ def generate_report(matched_results):
         f.write("\n\n*Note: Metrics are dynamically discovered from Artificial Analysis leaderboard.*\n")
 
     # 2. Generate Sortable HTML Report
-    html_table = report_df.to_html(index=False, classes="display", table_id="reportTable")
-    
-    html_content = f"""
+    html_header = f"""
     <!DOCTYPE html>
     <html>
     <head>
@@ -295,21 +434,26 @@ def generate_report(matched_results):
     <body>
         <h1>Free Models Performance Report</h1>
         <p>Generated on: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-        {html_table}
+        """
+    
+    html_footer = """
         <script>
-            $(document).ready(function() {{
-                $('#reportTable').DataTable({{
+            $(document).ready(function() {
+                $('#reportTable').DataTable({
                     "pageLength": 50,
                     "order": [[4, "desc"]] // Sort by Intelligence by default
-                }});
-            }});
+                });
+            });
         </script>
     </body>
     </html>
     """
     
+    # Stream the table straight into the file instead of building one large string
     with open(HTML_REPORT_FILE, "w", encoding="utf-8") as f:
-        f.write(html_content)
+        f.write(html_header)
+        report_df.to_html(buf=f, index=False, classes="display", table_id="reportTable")
+        f.write(html_footer)
 
     print(f"Reports generated: {REPORT_FILE} and {HTML_REPORT_FILE}")
 